@@ -134,17 +134,21 @@ def create_dataset(data_dir, cfg, batch_size=32, repeat_num=1, shuffle=True, mul
     def union_data(image, annot):
         i, a = read_dataset(image, annot)
         i, a = aug(i, a)
-        out = encode(i, a)
 
-        return out
+        return i, a
+
+    def encode_batch(images, annots, _batch_info):
+        return encode.encode_batch(images, annots)
 
     de_dataset = de_dataset.map(input_columns=["image", "annotation"],
-                                output_columns=["image", "truths", "conf", "landm"],
-                                column_order=["image", "truths", "conf", "landm"],
                                 operations=union_data,
                                 python_multiprocessing=multiprocessing,
                                 num_parallel_workers=num_worker)
-    de_dataset = de_dataset.batch(batch_size, drop_remainder=True)
+    de_dataset = de_dataset.batch(batch_size, drop_remainder=True,
+                                  per_batch_map=encode_batch,
+                                  input_columns=["image", "annotation"],
+                                  output_columns=["image", "truths", "conf", "landm"],
+                                  column_order=["image", "truths", "conf", "landm"])
     de_dataset = de_dataset.repeat(repeat_num)
 
     return de_dataset
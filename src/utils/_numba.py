@@ -0,0 +1,51 @@
+# Copyright 2022 Huawei Technologies Co., Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ============================================================================
+"""Numba-compiled kernels for prior box matching."""
+
+from numba import njit, prange
+
+
+@njit(cache=True, fastmath=True, parallel=True)
+def box_iou(a, b, out):
+    """
+    Compute IoU between a and b with a fused loop kernel.
+
+    Args:
+        a (numpy.ndarray): Which shape is [N,4], represents x1,y1,x2,y2(Top left and bottom right corner) of N boxes.
+        b (numpy.ndarray): Which shape is [M,4], represents x1,y1,x2,y2(Top left and bottom right corner) of M boxes.
+        out (numpy.ndarray): Preallocated [N,M] buffer receiving the result.
+
+    Returns:
+        A numpy ndarray with shape [N,M], means each box of a calculate intersection_area_size/union_area_size with
+            each box of b.
+    """
+    a_count = a.shape[0]
+    b_count = b.shape[0]
+    for i in prange(a_count):
+        ax1, ay1, ax2, ay2 = a[i, 0], a[i, 1], a[i, 2], a[i, 3]
+        area_a = (ax2 - ax1) * (ay2 - ay1)
+        for j in range(b_count):
+            inter_w = min(ax2, b[j, 2]) - max(ax1, b[j, 0])
+            if inter_w <= 0:
+                out[i, j] = 0
+                continue
+            inter_h = min(ay2, b[j, 3]) - max(ay1, b[j, 1])
+            if inter_h <= 0:
+                out[i, j] = 0
+                continue
+            inter = inter_w * inter_h
+            area_b = (b[j, 2] - b[j, 0]) * (b[j, 3] - b[j, 1])
+            out[i, j] = inter / (area_a + area_b - inter)
+    return out
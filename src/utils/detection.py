@@ -14,11 +14,20 @@
 # ============================================================================
 """Utils."""
 
-from itertools import product
-import math
+from functools import lru_cache
 
 import numpy as np
 
+try:
+    from utils._numba import box_iou as _box_iou_jit
+except ImportError:
+    _box_iou_jit = None
+
+try:
+    import numexpr as _ne
+except ImportError:
+    _ne = None
+
 
 def prior_box(image_sizes, min_sizes, steps, clip=False):
     """
@@ -36,20 +45,25 @@ def prior_box(image_sizes, min_sizes, steps, clip=False):
         A numpy ndarray with shape [N,4], which represents generated N prior boxes with x,y,width and height.
     """
     feature_maps = [
-        [math.ceil(image_sizes[0] / step), math.ceil(image_sizes[1] / step)]
+        [-(-image_sizes[0] // step), -(-image_sizes[1] // step)]
         for step in steps]
 
-    anchors = []
+    total = sum(f[0] * f[1] * len(min_sizes[k]) for k, f in enumerate(feature_maps))
+    output = np.empty((total, 4), dtype=np.float32)
+    cursor = 0
     for k, f in enumerate(feature_maps):
-        for i, j in product(range(f[0]), range(f[1])):
-            for min_size in min_sizes[k]:
-                s_kx = min_size / image_sizes[1]
-                s_ky = min_size / image_sizes[0]
-                cx = (j + 0.5) * steps[k] / image_sizes[1]
-                cy = (i + 0.5) * steps[k] / image_sizes[0]
-                anchors += [cx, cy, s_kx, s_ky]
-
-    output = np.asarray(anchors).reshape([-1, 4]).astype(np.float32)
+        cy, cx = np.meshgrid((np.arange(f[0]) + 0.5) * steps[k] / image_sizes[0],
+                             (np.arange(f[1]) + 0.5) * steps[k] / image_sizes[1],
+                             indexing='ij')
+        centers = np.stack([cx, cy], axis=-1).reshape(-1, 1, 2)
+        sizes = np.asarray(min_sizes[k], dtype=np.float64)
+        widths_heights = np.stack([sizes / image_sizes[1], sizes / image_sizes[0]], axis=-1)
+
+        count = centers.shape[0] * sizes.shape[0]
+        layer = output[cursor:cursor + count].reshape(centers.shape[0], sizes.shape[0], 4)
+        layer[:, :, 0:2] = centers
+        layer[:, :, 2:4] = widths_heights
+        cursor += count
 
     if clip:
         output = np.clip(output, 0, 1)
@@ -57,6 +71,17 @@ def prior_box(image_sizes, min_sizes, steps, clip=False):
     return output
 
 
+@lru_cache(maxsize=8)
+def _prior_box_cached(image_sizes, min_sizes, steps, clip=False):
+    """
+    Memoized prior_box. Arguments must be hashable, so min_sizes and steps are tuples here. The returned array is
+    shared between callers (e.g. dataset workers), hence it is marked read-only.
+    """
+    output = prior_box(image_sizes, [list(sizes) for sizes in min_sizes], list(steps), clip)
+    output.flags.writeable = False
+    return output
+
+
 def center_point2boxes(boxes):
     """
     Convert the box coordinate format from x,y,w,h to x1,y1,x2,y2.
@@ -83,102 +108,104 @@ def compute_intersect(a, b):
     Returns:
         A numpy ndarray with shape [N,M], means each box of a calculate intersection area size with each box of b.
     """
-    a_count = a.shape[0]
-    b_count = b.shape[0]
-    max_xy = np.minimum(
-        np.broadcast_to(np.expand_dims(a[:, 2:4], 1), [a_count, b_count, 2]),
-        np.broadcast_to(np.expand_dims(b[:, 2:4], 0), [a_count, b_count, 2]))
-    min_xy = np.maximum(
-        np.broadcast_to(np.expand_dims(a[:, 0:2], 1), [a_count, b_count, 2]),
-        np.broadcast_to(np.expand_dims(b[:, 0:2], 0), [a_count, b_count, 2]))
-    inter = np.maximum((max_xy - min_xy), np.zeros_like(max_xy - min_xy))
+    max_xy = np.minimum(a[:, None, 2:4], b[None, :, 2:4])
+    min_xy = np.maximum(a[:, None, 0:2], b[None, :, 0:2])
+    inter = (max_xy - min_xy).clip(min=0)
     return inter[:, :, 0] * inter[:, :, 1]
 
 
-def compute_overlaps(a, b):
+def compute_overlaps(a, b, out=None):
     """
     Compute IoU between a and b.
 
     Args:
         a (numpy.ndarray): Which shape is [N,4], represents x1,y1,x2,y2(Top left and bottom right corner) of N boxes.
         b (numpy.ndarray): Which shape is [M,4], represents x1,y1,x2,y2(Top left and bottom right corner) of M boxes.
+        out (numpy.ndarray): Optional preallocated [N,M] buffer receiving the result, avoids a fresh allocation
+            per call.
 
     Returns:
         A numpy ndarray with shape [N,M], means each box of a calculate intersection_area_size/union_area_size with each
          box of b.
     """
+    # With a single box on either side the pairing is degenerate and plain 1-D arithmetic beats both the broadcast
+    # machinery and the jitted kernel's dispatch overhead.
+    if a.shape[0] == 1 or b.shape[0] == 1:
+        top_left = np.maximum(a[:, 0:2], b[:, 0:2])
+        bottom_right = np.minimum(a[:, 2:4], b[:, 2:4])
+        inter = np.prod(np.clip(bottom_right - top_left, 0, None), axis=1)
+        area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+        area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+        iou = (inter / (area_a + area_b - inter)).reshape(a.shape[0], b.shape[0])
+        if out is not None:
+            out[...] = iou
+            return out
+        return iou
+    if _box_iou_jit is not None:
+        if out is None:
+            out = np.empty((a.shape[0], b.shape[0]), dtype=np.result_type(a, b))
+        return _box_iou_jit(np.ascontiguousarray(a), np.ascontiguousarray(b), out)
     inter = compute_intersect(a, b)
-    area_a = np.broadcast_to(
-        np.expand_dims(
-            (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1]), 1),
-        np.shape(inter))
-    area_b = np.broadcast_to(
-        np.expand_dims(
-            (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1]), 0),
-        np.shape(inter))
-    union = area_a + area_b - inter
-    return inter / union
-
-
-def match(threshold, boxes, priors, var, labels, landms):
-    """
-    Prior box matching function. During the training, it is necessary to determine which prior frame matches the
-    ground truth in the training image first, and the boundary frame corresponding to the matched prior frame will
-    be responsible for predicting it. There are two matching principles between prior frame and ground truth. The
-    first is that for each ground truth in the image, find the prior box with the largest IoU of it,which matches with
-    it, so that each ground truth must match with a prior. Second, for the remaining unmatched prior boxes, if a ground
-    truth and its IOU are greater than a certain threshold (generally set to 0.5), then change prior and the ground
-    truth, The remaining prior frames that are not matched are all negative samples (if the IOU of multiple ground
-    truths and a prior frame are all greater than the threshold, prior will only match the one with the largest IOU).
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.divide(inter, union, out=inter if out is None else out)
 
-    Args:
-        threshold (float): IoU threshold, decide whether set to background.
-        boxes (numpy.ndarray): Ground truth boxes, whose shape is [N,4] represents x1,y1,x2,y2 of N boxes.
-        priors (numpy.ndarray): Prior boxes, whose shape is [M,4] represents x,y,w,h of M boxes.
-        var (list): Variance of priors.
-        labels (numpy.ndarray): Label of boxes.
-        landms (numpy.ndarray): Landmarks correspond to boxes, whose shape is [N,10], represents 5 pair of (x,y) for
-            N boxes.
 
-    Returns:
-        A tuple,represents matched and encoded boxes, confidence and landmarks.
-    """
-    centerbox = center_point2boxes(priors)
-    overlaps = compute_overlaps(boxes, centerbox)
+def _zero_targets(num_priors):
+    """Encoded targets of an all-background image."""
+    loc = np.zeros((num_priors, 4), dtype=np.float32)
+    conf = np.zeros((num_priors,), dtype=np.int32)
+    landm = np.zeros((num_priors, 10), dtype=np.float32)
+    return loc, conf, landm
 
+
+def _envelope_candidates(boxes, centerbox):
+    """Indices of the priors whose axis-aligned box intersects at least one GT box."""
+    return np.flatnonzero(
+        ((boxes[:, None, 0] < centerbox[None, :, 2]) & (boxes[:, None, 2] > centerbox[None, :, 0]) &
+         (boxes[:, None, 1] < centerbox[None, :, 3]) & (boxes[:, None, 3] > centerbox[None, :, 1])).any(axis=0))
+
+
+def _match_candidates(threshold, boxes, priors, var, labels, landms, candidates, overlaps, inv_wh_var=None):
+    """Assign and encode targets for one image given its [N,k] IoU matrix over the candidate priors."""
+    if inv_wh_var is None:
+        inv_wh_var = 1.0 / (var[0] * priors[:, 2:4])
     # The prior box that overlaps most with the annotation box
-    best_prior_overlap = overlaps.max(1, keepdims=True)
-    best_prior_idx = np.argsort(-overlaps, axis=1)[:, 0:1]
+    best_prior_overlap = overlaps.max(axis=1)
+    best_prior_idx = candidates[overlaps.argmax(axis=1)]
 
-    valid_gt_idx = best_prior_overlap[:, 0] >= 0.2
-    best_prior_idx_filter = best_prior_idx[valid_gt_idx, :]
+    valid_gt_idx = best_prior_overlap >= 0.2
+    best_prior_idx_filter = best_prior_idx[valid_gt_idx]
     if best_prior_idx_filter.shape[0] <= 0:
-        loc = np.zeros((priors.shape[0], 4), dtype=np.float32)
-        conf = np.zeros((priors.shape[0],), dtype=np.int32)
-        landm = np.zeros((priors.shape[0], 10), dtype=np.float32)
-        return loc, conf, landm
-
-    # The closest annotation box of each prior box
-    best_truth_overlap = overlaps.max(0, keepdims=True)
-    best_truth_idx = np.argsort(-overlaps, axis=0)[:1, :]
-
-    best_truth_idx = best_truth_idx.squeeze(0)
-    best_truth_overlap = best_truth_overlap.squeeze(0)
-    best_prior_idx = best_prior_idx.squeeze(1)
-    best_prior_idx_filter = best_prior_idx_filter.squeeze(1)
+        return _zero_targets(priors.shape[0])
+
+    # The closest annotation box of each prior box; priors outside every envelope keep overlap 0 and index 0, which
+    # is what a dense argmax over their all-zero columns would produce.
+    best_truth_overlap = np.zeros((priors.shape[0],), dtype=overlaps.dtype)
+    best_truth_idx = np.zeros((priors.shape[0],), dtype=np.int64)
+    best_truth_overlap[candidates] = overlaps.max(axis=0)
+    best_truth_idx[candidates] = overlaps.argmax(axis=0)
     best_truth_overlap[best_prior_idx_filter] = 2
 
-    for j in range(best_prior_idx.shape[0]):
-        best_truth_idx[best_prior_idx[j]] = j
+    best_truth_idx[best_prior_idx] = np.arange(best_prior_idx.shape[0], dtype=best_truth_idx.dtype)
 
     matches = boxes[best_truth_idx]
 
     # encode boxes
     offset_cxcy = (matches[:, 0:2] + matches[:, 2:4]) / 2 - priors[:, 0:2]
-    offset_cxcy /= (var[0] * priors[:, 2:4])
+    offset_cxcy *= inv_wh_var
     wh = (matches[:, 2:4] - matches[:, 0:2]) / priors[:, 2:4]
-    wh[wh == 0] = 1e-12
-    wh = np.log(wh) / var[1]
+    if _ne is not None:
+        # Degenerate boxes are rare, so pick their scaled log(1e-12) sentinel with a where() instead of flooring
+        # every element first; numexpr fuses the log, scale and select into one pass.
+        wh = _ne.evaluate("where(wh > 0, log(wh) * inv_v, sentinel)",
+                          local_dict={"wh": wh,
+                                      "inv_v": wh.dtype.type(1.0 / var[1]),
+                                      "sentinel": wh.dtype.type(np.log(1e-12) / var[1])})
+    else:
+        np.log(np.maximum(wh, 1e-12, out=wh), out=wh)
+        wh *= 1.0 / var[1]
     loc = np.concatenate([offset_cxcy, wh], axis=1)
 
     conf = labels[best_truth_idx]
@@ -188,14 +215,64 @@ def match(threshold, boxes, priors, var, labels, landms):
 
     # encode landms
     matched = np.reshape(matches_landm, [-1, 5, 2])
-    priors = np.broadcast_to(np.expand_dims(priors, 1), [priors.shape[0], 5, 4])
-    offset_cxcy = matched[:, :, 0:2] - priors[:, :, 0:2]
-    offset_cxcy /= (priors[:, :, 2:4] * var[0])
+    offset_cxcy = matched - priors[:, None, 0:2]
+    offset_cxcy *= inv_wh_var[:, None, :]
     landm = np.reshape(offset_cxcy, [-1, 10])
 
     return loc, np.array(conf, dtype=np.int32), landm
 
 
+def match(threshold, boxes, priors, var, labels, landms, iou_buf=None, priors_xyxy=None, inv_wh_var=None):
+    """
+    Prior box matching function. During the training, it is necessary to determine which prior frame matches the
+    ground truth in the training image first, and the boundary frame corresponding to the matched prior frame will
+    be responsible for predicting it. There are two matching principles between prior frame and ground truth. The
+    first is that for each ground truth in the image, find the prior box with the largest IoU of it,which matches with
+    it, so that each ground truth must match with a prior. Second, for the remaining unmatched prior boxes, if a ground
+    truth and its IOU are greater than a certain threshold (generally set to 0.5), then change prior and the ground
+    truth, The remaining prior frames that are not matched are all negative samples (if the IOU of multiple ground
+    truths and a prior frame are all greater than the threshold, prior will only match the one with the largest IOU).
+
+    Args:
+        threshold (float): IoU threshold, decide whether set to background.
+        boxes (numpy.ndarray): Ground truth boxes, whose shape is [N,4] represents x1,y1,x2,y2 of N boxes.
+        priors (numpy.ndarray): Prior boxes, whose shape is [M,4] represents x,y,w,h of M boxes.
+        var (list): Variance of priors.
+        labels (numpy.ndarray): Label of boxes.
+        landms (numpy.ndarray): Landmarks correspond to boxes, whose shape is [N,10], represents 5 pair of (x,y) for
+            N boxes.
+        iou_buf (numpy.ndarray): Optional preallocated buffer for the IoU matrix, reused across calls when it is
+            large enough for the current sample.
+        priors_xyxy (numpy.ndarray): Optional precomputed x1,y1,x2,y2 form of priors, computed on the fly when
+            absent. Priors never change across samples, so callers can convert once.
+        inv_wh_var (numpy.ndarray): Optional precomputed 1/(var[0]*prior_wh) factors used by the offset encoding,
+            likewise constant across samples.
+
+    Returns:
+        A tuple,represents matched and encoded boxes, confidence and landmarks.
+    """
+    # Priors are float32 and the encoded outputs feed float32 training tensors, so keep the whole match in float32;
+    # the [N,M] overlap matrix is the memory bottleneck and float64 would double its traffic.
+    boxes = boxes.astype(np.float32, copy=False)
+    landms = landms.astype(np.float32, copy=False)
+
+    centerbox = priors_xyxy if priors_xyxy is not None else center_point2boxes(priors)
+
+    # Most priors are spatially far from every GT, so their IoU is zero. A cheap axis-aligned envelope test keeps
+    # only the priors that intersect at least one GT and the IoU matrix shrinks from [N,M] to [N,k] with k << M.
+    candidates = _envelope_candidates(boxes, centerbox)
+    if candidates.shape[0] <= 0:
+        return _zero_targets(priors.shape[0])
+
+    out = None
+    if iou_buf is not None and iou_buf.shape[0] >= boxes.shape[0] and iou_buf.shape[1] >= candidates.shape[0]:
+        out = iou_buf[:boxes.shape[0], :candidates.shape[0]]
+    overlaps = compute_overlaps(boxes, centerbox[candidates], out=out)
+
+    return _match_candidates(threshold, boxes, priors, var, labels, landms, candidates, overlaps,
+                             inv_wh_var=inv_wh_var)
+
+
 class BboxEncoder:
     """
     For the input annotation box data, generate the offset and variance between each prior box and key point data and
@@ -218,13 +295,20 @@ class BboxEncoder:
         bounding box, confidence and landmark.
     """
 
+    # Initial row capacity of the reused IoU buffer; encode_batch grows it on demand when a batch carries more
+    # GT boxes in total.
+    max_gt = 64
+
     def __init__(self, config):
         self.match_thresh = config['match_thresh']
         self.variances = config['variance']
-        self.priors = prior_box((config['image_size'], config['image_size']),
-                                [[16, 32], [64, 128], [256, 512]],
-                                [8, 16, 32],
-                                config['clip'])
+        self.priors = _prior_box_cached((config['image_size'], config['image_size']),
+                                        ((16, 32), (64, 128), (256, 512)),
+                                        (8, 16, 32),
+                                        config['clip'])
+        self.priors_xyxy = center_point2boxes(self.priors)
+        self._inv_wh_var = (1.0 / (self.variances[0] * self.priors[:, 2:4])).astype(np.float32)
+        self._iou_buf = np.empty((self.max_gt, self.priors.shape[0]), dtype=np.float32)
 
     def __call__(self, image, targets):
         boxes = targets[:, :4]
@@ -232,10 +316,55 @@ class BboxEncoder:
         landms = targets[:, 4:14]
         priors = self.priors
 
-        loc_t, conf_t, landm_t = match(self.match_thresh, boxes, priors, self.variances, labels, landms)
+        loc_t, conf_t, landm_t = match(self.match_thresh, boxes, priors, self.variances, labels, landms,
+                                       iou_buf=self._iou_buf, priors_xyxy=self.priors_xyxy,
+                                       inv_wh_var=self._inv_wh_var)
 
         return image, loc_t, conf_t, landm_t
 
+    def encode_batch(self, images, targets_list):
+        """
+        Encode a whole mini-batch at once. GT boxes of all images are stacked and a single IoU matrix against the
+        shared candidate priors is computed, then the per-image assignment runs on row slices of it. This amortizes
+        the fixed per-call cost of __call__ across the batch.
+
+        Args:
+            images (list): Images of the batch.
+            targets_list (list): Per-image annotation arrays with the same layout as the targets of __call__.
+
+        Returns:
+            A tuple of four lists: images, encoded boxes, confidences and landmarks, one entry per input image.
+        """
+        num_priors = self.priors.shape[0]
+        counts = [targets.shape[0] for targets in targets_list]
+        all_boxes = np.concatenate([targets[:, :4] for targets in targets_list]).astype(np.float32, copy=False)
+
+        candidates = _envelope_candidates(all_boxes, self.priors_xyxy)
+        if candidates.shape[0] <= 0:
+            zeros = [_zero_targets(num_priors) for _ in targets_list]
+            return list(images), [z[0] for z in zeros], [z[1] for z in zeros], [z[2] for z in zeros]
+
+        if self._iou_buf.shape[0] < all_boxes.shape[0]:
+            self._iou_buf = np.empty((all_boxes.shape[0], num_priors), dtype=np.float32)
+        out = self._iou_buf[:all_boxes.shape[0], :candidates.shape[0]]
+        overlaps = compute_overlaps(all_boxes, self.priors_xyxy[candidates], out=out)
+
+        loc_list, conf_list, landm_list = [], [], []
+        start = 0
+        for targets, count in zip(targets_list, counts):
+            labels = targets[:, -1]
+            landms = targets[:, 4:14].astype(np.float32, copy=False)
+            loc_t, conf_t, landm_t = _match_candidates(self.match_thresh, all_boxes[start:start + count],
+                                                       self.priors, self.variances, labels, landms,
+                                                       candidates, overlaps[start:start + count],
+                                                       inv_wh_var=self._inv_wh_var)
+            loc_list.append(loc_t)
+            conf_list.append(conf_t)
+            landm_list.append(landm_t)
+            start += count
+
+        return list(images), loc_list, conf_list, landm_list
+
 
 def decode_bbox(bbox, priors, var):
     """
@@ -250,17 +379,20 @@ def decode_bbox(bbox, priors, var):
     Returns:
         A numpy ndarray, whose shape is [N,4], represents top left and bottom right point coordinates of N boxes.
     """
-    boxes = np.concatenate((
-        priors[:, 0:2] + bbox[:, 0:2] * var[0] * priors[:, 2:4],
-
-        # (xc, yc, w, h)
-        priors[:, 2:4] * np.exp(bbox[:, 2:4] * var[1])), axis=1)
-
-    # (x0, y0, w, h)
-    boxes[:, :2] -= boxes[:, 2:] / 2
+    # (xc, yc) and (w, h); numexpr fuses the multiply/exp/multiply chain into one vectorized pass
+    centers = priors[:, 0:2] + bbox[:, 0:2] * var[0] * priors[:, 2:4]
+    if _ne is not None:
+        sizes = _ne.evaluate("p_wh * exp(b_wh * v1)",
+                             local_dict={"p_wh": priors[:, 2:4],
+                                         "b_wh": bbox[:, 2:4],
+                                         "v1": priors.dtype.type(var[1])})
+    else:
+        sizes = priors[:, 2:4] * np.exp(bbox[:, 2:4] * var[1])
 
     # (x0, y0, x1, y1)
-    boxes[:, 2:] += boxes[:, :2]
+    boxes = np.empty_like(bbox)
+    boxes[:, 0:2] = centers - sizes / 2
+    boxes[:, 2:4] = boxes[:, 0:2] + sizes
     return boxes
 
 
@@ -278,9 +410,7 @@ def decode_landm(landm, priors, var):
         A numpy ndarray, whose shape is [N,10], represents 5 pairs of coordinate of N bounding boxes.
     """
 
-    return np.concatenate((priors[:, 0:2] + landm[:, 0:2] * var[0] * priors[:, 2:4],
-                           priors[:, 0:2] + landm[:, 2:4] * var[0] * priors[:, 2:4],
-                           priors[:, 0:2] + landm[:, 4:6] * var[0] * priors[:, 2:4],
-                           priors[:, 0:2] + landm[:, 6:8] * var[0] * priors[:, 2:4],
-                           priors[:, 0:2] + landm[:, 8:10] * var[0] * priors[:, 2:4],
-                           ), axis=1)
+    points = landm.reshape(-1, 5, 2)
+    priors_xy = priors[:, None, 0:2]
+    priors_wh = priors[:, None, 2:4] * var[0]
+    return (priors_xy + points * priors_wh).reshape(-1, 10)